@@ -0,0 +1,334 @@
+"""Assorted DNS-related tools.
+
+These are helpers that sit on top of the cache in se_dns.dnsutil,
+answering higher-level questions like "which IP addresses does this
+server have?" and "are these two host names the same machine?".
+"""
+
+from __future__ import absolute_import
+
+import os
+import ssl
+import pwd
+import json
+import time
+import socket
+import ipaddress
+
+try:
+    import urllib2
+    import httplib
+except ImportError:
+    # Python 3.
+    import urllib.request as urllib2
+    import http.client as httplib
+
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+import se_dns
+
+from se_dns.dnsutil import DNSCache
+
+DNS_CACHE = DNSCache()
+
+# In-process memo of (timestamp, addresses) per include_external value,
+# so that repeated calls do not even have to stat the cache file.
+_LOCAL_IP_ADDRESSES_CACHE = {}
+_LOCAL_IP_CACHE_TTL = 60 * 60 * 24
+
+# The host name never changes within a process, so look it up once.
+_HOSTNAME = socket.gethostname()
+
+# Pool for dispatching independent DNS queries concurrently; the
+# sockets release the GIL, so waiting happens in parallel.  Created
+# lazily per process: a pool inherited across fork (Exim forks for
+# every delivery) would reference worker threads that do not exist in
+# the child, and submitted work would never complete.
+_POOL = None
+_POOL_PID = None
+
+
+def _get_pool():
+    """Return this process's query pool, creating it on first use."""
+    global _POOL, _POOL_PID
+    pid = os.getpid()
+    if _POOL is None or _POOL_PID != pid:
+        _POOL = ThreadPoolExecutor(max_workers=8)
+        _POOL_PID = pid
+    return _POOL
+
+
+# Memoized name_to_ip results.  getaddrinfo is a blocking libc call,
+# serialized by an internal lock, so avoid repeating it for hosts that
+# were resolved recently.
+_NAME_TO_IP_CACHE = {}
+_NAME_TO_IP_MAX_SIZE = 1024
+_NAME_TO_IP_TTL = 60
+
+
+def local_ip_addresses(cache_fn, include_external=False, use_cached=False,
+                       logger=None):
+    """Get all the IP addresses in use on this server."""
+    if use_cached:
+        try:
+            when, result = _LOCAL_IP_ADDRESSES_CACHE[include_external]
+            if time.time() - when < _LOCAL_IP_CACHE_TTL:
+                return result
+        except KeyError:
+            pass
+        try:
+            cache_good = (time.time() - os.stat(cache_fn).st_mtime <
+                          _LOCAL_IP_CACHE_TTL)
+        except (OSError, EOFError, IOError) as e:
+            if logger:
+                logger.debug("Not using cache: %s", e)
+            cache_good = False
+        if cache_good:
+            with open(cache_fn) as cache_file:
+                try:
+                    result = json.load(cache_file)
+                except (OSError, EOFError, IOError, ValueError) as e:
+                    if logger:
+                        logger.warn("Bad local IP address cache (%s); "
+                                    "replacing.", e)
+                else:
+                    if logger:
+                        logger.debug("Using cache for local IP addresses.")
+                    _LOCAL_IP_ADDRESSES_CACHE[include_external] = \
+                        (time.time(), result)
+                    return result
+        elif logger:
+            logger.debug("Not using cache for local IP addresses.")
+    ips = set()
+    for interface, addresses in psutil.net_if_addrs().items():
+        if interface == "lo":
+            continue
+        for address in addresses:
+            if address.family not in (socket.AF_INET, socket.AF_INET6):
+                continue
+            # Link-local IPv6 addresses may have a zone index appended.
+            ip = address.address.split("%", 1)[0]
+            if ip.startswith(("127.", "fe80", "::1")):
+                continue
+            ips.add(ip)
+    if include_external:
+        req = urllib2.Request(include_external,
+                              headers={"User-Agent": "se_dns/%s " %
+                                       se_dns.__version__})
+        # XXX We should use requests.
+        try:
+            local_ip = urllib2.urlopen(
+                req, timeout=5).read().decode("ascii").strip()
+        except (socket.error, socket.timeout, urllib2.URLError,
+                httplib.HTTPException) as e:
+            if logger:
+                if hasattr(e, "errno") and e.errno == 101:
+                    # Network issue. Nothing we can do about this.
+                    logger.info("Unable to retrieve external IP: %s", e)
+                else:
+                    logger.warn("Unable to retrieve external IP: %s", e)
+        else:
+            if local_ip.startswith("::ffff:"):
+                # This is junk that nginx adds to IPv4 addresses.
+                local_ip = local_ip.rsplit(":", 1)[1]
+            ips.add(local_ip)
+    # No longer add data to ips, we can convert it to a list to serialize it
+    ips = list(ips)
+    if logger:
+        logger.info("Local IP addresses: %s", ", ".join(ips))
+    adjust_cache = not os.path.exists(cache_fn)
+    try:
+        with open(cache_fn, "w") as cache_file:
+            json.dump(ips, cache_file)
+    except (IOError, OSError) as e:
+        if logger:
+            logger.warn("Unable to cache IP list: %s", e)
+    else:
+        # XXX This should not have the users hard-coded.
+        if adjust_cache:
+            # The cache might be created by the API (www-data), local_scan
+            # (Debian-exim), or setup/update (root).  Ensure that everyone
+            # can work with it.  The www-data user is in the Debian-exim
+            # group.
+            try:
+                os.chmod(cache_fn, 0o660)
+            except OSError as e:
+                if logger:
+                    logger.info("Unable to set permissions of cache: %s", e)
+            try:
+                os.chown(cache_fn, os.geteuid(),
+                         pwd.getpwnam("Debian-exim").pw_gid)
+            except (OSError, IOError, KeyError) as e:
+                if logger:
+                    logger.info("Unable to set owner/group of cache: %s", e)
+    # ips was built as a set, so it is already unique.
+    _LOCAL_IP_ADDRESSES_CACHE[include_external] = (time.time(), ips)
+    return ips
+
+
+def name_to_ip(name, prefer_ipv6=True):
+    """Basically like socket.gethostbyname(), except that it also supports
+    IPv6.  The caller is responsible for setting an appropriate timeout and
+    handling any errors.
+
+    The result is cached for a minute, so that repeated checks for the
+    same host do not block on the resolver each time."""
+    key = (name, prefer_ipv6)
+    try:
+        expiry, result = _NAME_TO_IP_CACHE[key]
+        if expiry > time.time():
+            return result
+    except KeyError:
+        pass
+    ipv4 = None
+    ipv6 = None
+    # XXX We really want a timeout on this somehow.  Can we do this
+    # XXX differently to make that possible?  We don't want to use
+    # XXX signals, because that causes issues with Exim.  We could use
+    # XXX a subprocess or thread, although that's a bit ugly.
+    for (family, socktype, proto, canonname,
+         sockaddr) in socket.getaddrinfo(name, None):
+        if family == socket.AF_INET6:
+            ipv6 = sockaddr[0]
+            if prefer_ipv6:
+                break
+        elif family == socket.AF_INET:
+            ipv4 = sockaddr[0]
+    if prefer_ipv6 and ipv6:
+        result = ipv6
+    else:
+        result = ipv4 or ipv6
+    if len(_NAME_TO_IP_CACHE) >= _NAME_TO_IP_MAX_SIZE:
+        # Keep the cache bounded; this is simpler than tracking LRU
+        # order and the cache refills almost immediately.
+        _NAME_TO_IP_CACHE.clear()
+    _NAME_TO_IP_CACHE[key] = (time.time() + _NAME_TO_IP_TTL, result)
+    return result
+
+
+def _known_unresolvable(host):
+    """Whether recent lookups showed that the host has no addresses."""
+    return (DNS_CACHE.is_known_nxdomain(host, "A") and
+            DNS_CACHE.is_known_nxdomain(host, "AAAA"))
+
+
+def hosts_equal(host1, host2, cache_fn, skip_getaddrinfo=False, logger=None,
+                external_link=None):
+    """Return True if these are the same physical machine."""
+    if host1 == host2:
+        return True
+    # Currently we just check if the hosts resolve to the same IP, with
+    # some special-casing for localhost.
+    hostname = _HOSTNAME
+    host1_is_ip = False
+    host2_is_ip = False
+    # Only try to parse arguments that could be an address - most are
+    # host names, and raising ValueError for each of those is costly.
+    ip1 = None
+    if ":" in host1 or host1[:1].isdigit():
+        try:
+            ip1 = ipaddress.ip_address(host1)
+        except ValueError:
+            pass
+    if ip1 is None:
+        if host1 == "localhost":
+            host1 = hostname
+    elif ip1.is_loopback or (hasattr(ip1, "is_site_local") and
+                             ip1.is_site_local):
+        host1 = hostname
+    else:
+        host1_is_ip = True
+    ip2 = None
+    if ":" in host2 or host2[:1].isdigit():
+        try:
+            ip2 = ipaddress.ip_address(host2)
+        except ValueError:
+            pass
+    if ip2 is None:
+        if host2 == "localhost":
+            host2 = hostname
+    elif ip2.is_loopback or (hasattr(ip2, "is_site_local") and
+                             ip2.is_site_local):
+        host2 = hostname
+    else:
+        host2_is_ip = True
+    # Try DNS lookups first, dispatching the independent queries in
+    # parallel, so the wait costs roughly one round-trip instead of
+    # four.
+    host1_queries = []
+    host2_queries = []
+    if not host1_is_ip:
+        host1_queries = [_get_pool().submit(DNS_CACHE.lookup, host1, qtype,
+                                      exact=True)
+                         for qtype in ("A", "AAAA")]
+    if not host2_is_ip:
+        host2_queries = [_get_pool().submit(DNS_CACHE.lookup, host2, qtype,
+                                      exact=True)
+                         for qtype in ("A", "AAAA")]
+    host1_ips = set()
+    if ip1:
+        host1_ips.add(str(ip1))
+    if host1 == hostname:
+        host1_ips.update(local_ip_addresses(cache_fn,
+                                            include_external=external_link,
+                                            use_cached=True, logger=logger))
+    for query in host1_queries:
+        host1_ips.update(query.result())
+    # Collect host2's addresses incrementally, stopping as soon as one
+    # matches.
+    host2_ips = set()
+    if ip2:
+        host2_ips.add(str(ip2))
+    if host2 == hostname:
+        host2_ips.update(local_ip_addresses(cache_fn,
+                                            include_external=external_link,
+                                            use_cached=True, logger=logger))
+    if host1_ips & host2_ips:
+        return True
+    for query in host2_queries:
+        host2_ips.update(query.result())
+        if host1_ips & host2_ips:
+            return True
+    if skip_getaddrinfo:
+        return False
+    # If DNS just told us that neither host resolves at all, then the
+    # blocking fallback cannot find a match, so skip it.  When only
+    # one side failed we still fall through, because getaddrinfo goes
+    # through NSS and may know names (e.g. from /etc/hosts) that DNS
+    # does not.
+    if (not host1_is_ip and not host2_is_ip and
+            _known_unresolvable(host1) and _known_unresolvable(host2)):
+        return False
+    # Fall back to getaddrinfo.
+    try:
+        if host1_is_ip:
+            host1_ip = host1
+        else:
+            host1_ip = name_to_ip(host1)
+        if host2_is_ip:
+            host2_ip = host2
+        else:
+            host2_ip = name_to_ip(host2)
+        return host1_ip == host2_ip
+    except (socket.error, UnicodeError):
+        return False
+
+
+def host_in_list(host, host_list, cache_fn, skip_getaddrinfo=False,
+                 logger=None, external_link=None):
+    """Return True if the host is equal to any of the ones in the specified
+    list.
+    """
+    return any(hosts_equal(host, other_host, cache_fn, skip_getaddrinfo,
+                           logger, external_link)
+               for other_host in host_list)
+
+
+def urlopen(url, data=None, timeout=None):
+    if hasattr(ssl, '_create_unverified_context'):
+        ssl_context = ssl._create_unverified_context()
+        return urllib2.urlopen(url, data, timeout, context=ssl_context)
+    else:
+        return urllib2.urlopen(url)
@@ -24,10 +24,16 @@ This code was originally based on the dnscache in SpamBayes.
 from __future__ import absolute_import
 
 import os
+import sys
+import copy
 import json
+import time
 import struct
 import random
 import logging
+import functools
+import itertools
+import collections
 
 import dns.resolver
 import dns.exception
@@ -43,15 +49,87 @@ LabelTooLong = dns.name.LabelTooLong
 # Default config_path hardcoded
 CONFIG_PATH = "/etc/combined_lists.json"
 
+# Loggers are singletons, so fetch ours once instead of taking the
+# logging module's lock in every constructor.
+_LOGGER = logging.getLogger("se-dns")
+
+# Memoized dns.rdatatype.from_text / dns.rdataclass.from_text results;
+# lookups use the same handful of types over and over, so prefill the
+# common ones and fall back to from_text for anything else.
+_RDTYPES = {name: dns.rdatatype.from_text(name)
+            for name in ("A", "AAAA", "MX", "TXT", "PTR", "NS", "CNAME",
+                         "SOA")}
+_RDCLASSES = {"IN": dns.rdataclass.IN}
+
+# Shared result for negative lookups; callers only iterate the result,
+# so one immutable empty tuple avoids allocating a fresh list per miss.
+_EMPTY = ()
+
+# Likewise for the "listed" answer of the combined lists.
+_LISTED = ("127.0.0.2",)
+
+# Upper bound for the resolver cache and the failures cache, so that
+# long-running processes cannot grow them without limit.
+CACHE_MAX_SIZE = 100000
+
+
+def reverse_name(ip):
+    """Return the reverse-lookup (PTR) name for an IP address.
+
+    The common IPv4 case is plain string manipulation, which is much
+    cheaper than dns.reversename.from_address; IPv6 addresses fall
+    back to the general implementation."""
+    if ":" in ip:
+        return dns.reversename.from_address(ip).to_text()
+    a, b, c, d = ip.split(".")
+    return "%s.%s.%s.%s.in-addr.arpa." % (d, c, b, a)
+
+
+@functools.lru_cache(maxsize=1)
+def _default_resolver():
+    """Parse /etc/resolv.conf once per process.
+
+    Constructing dns.resolver.Resolver re-reads the file every time;
+    instances shallow-copy this template instead, so that each still
+    gets its own lifetime, cache and nameservers attributes."""
+    return dns.resolver.Resolver()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_config(config_path):
+    """Load the combined-list configuration, once per path.
+
+    Constructing additional _DNSCache objects (e.g. in tests or
+    subclasses) reuses the parsed data instead of re-reading the file;
+    call _load_config.cache_clear() to pick up changes on disk."""
+    if os.path.exists(config_path):
+        with open(config_path, "r") as fh:
+            return json.load(fh)
+    return {
+        "COMBINED": "",
+        "COMBINED_URL": "",
+        "COMBINED_DNSBL": {},
+        "COMBINED_DNSBL_REVERSE": {},
+        "COMBINED_URLBL": {},
+        "COMBINED_URLBL_REVERSE": {}
+    }
+
 
 class Cache(object):
     """Provide a simple-to-use interface to DNS lookups, which caches the
     results in memory."""
     timeout_log_level = "info"
 
+    # Query types for which an empty answer is unremarkable.
+    _QUIET_QTYPES = frozenset(("MX", "AAAA", "TXT"))
+
     def __init__(self, dnsserver=None, dnstimeout=10,
-                 minttl=0, cachefile=""):
-        self.logger = logging.getLogger("se-dns")
+                 minttl=0, cachefile="", cache_size=CACHE_MAX_SIZE,
+                 retries=3):
+        self.logger = _LOGGER
+        # Resolve the timeout log method once; subclasses choose the
+        # level with the timeout_log_level class attribute.
+        self._timeout_log = getattr(self.logger, self.timeout_log_level)
         # We don't use the cachefile argument, but it may be provided.
         # XXX We can probably just drop cachefile now.
         if cachefile:
@@ -61,7 +139,7 @@ class Cache(object):
         # this up a bit is probably reasonable.
         self.minTTL = minttl
 
-        self.queryObj = dns.resolver.Resolver()
+        self.queryObj = copy.copy(_default_resolver())
         if dnsserver:
             self.queryObj.nameservers = [dnsserver]
 
@@ -69,68 +147,157 @@ class Cache(object):
         # dnspython has a "timeout" value (for each nameserver) and a
         # "lifetime" value (for the complete query).  We're happy with the
         # 2 second default timeout, but want to limit the overall query.
-        self.queryObj.lifetime = dnstimeout
-
-        # Use the package's caching system.
-        self.queryObj.cache = dns.resolver.Cache()
+        # The overall budget is split across the retry attempts, so
+        # that retrying a lost packet does not make the worst case
+        # slower than a single long wait.
+        self.retries = retries
+        self.queryObj.lifetime = dnstimeout / float(retries)
+
+        # Use the package's caching system.  The LRU variant stays
+        # bounded with O(1) eviction, unlike dns.resolver.Cache, which
+        # grows without limit and periodically scans every entry.
+        self.queryObj.cache = dns.resolver.LRUCache(max_size=cache_size)
         # For our custom NS lookups.
         self.ns_cache = {}
         # Except that we also want to cache failures, because we are
         # generally short-lived, and sometimes errors are slow to generate.
-        self.failures = {}
+        # Maps key -> expiry (monotonic), LRU-bounded.
+        self.failures = collections.OrderedDict()
+        self.neg_ttl = 300
+        self.neg_max = 10000
+
+    def _cache_failure(self, key, ttl=None):
+        """Remember a negative result for a while, keeping the cache
+        bounded with LRU eviction."""
+        if ttl is None:
+            ttl = self.neg_ttl
+        self.failures[key] = time.monotonic() + ttl
+        self.failures.move_to_end(key)
+        if len(self.failures) > self.neg_max:
+            self.failures.popitem(last=False)
+
+    _NEG_TTL_MAX = 3600
+
+    def _negative_ttl(self, exc):
+        """The TTL for a negative answer, taken from the SOA record in
+        the authority section when the server provided one (RFC 2308),
+        and capped so that a generous SOA cannot pin a stale result.
+
+        Returns None when no TTL is available, so that _cache_failure
+        falls back to the default."""
+        try:
+            responses = exc.kwargs.get("responses")
+            if responses:
+                # NXDOMAIN carries one response per qname tried.
+                response = next(iter(responses.values()))
+            else:
+                response = exc.kwargs["response"]
+            ttl = response.authority[0].ttl
+        except (AttributeError, KeyError, IndexError, TypeError):
+            return None
+        return min(ttl, self._NEG_TTL_MAX)
+
+    def _query_with_retry(self, resolver, *args, **kwargs):
+        """Issue the query, retrying timed-out attempts.
+
+        A single lost UDP packet then costs one short attempt rather
+        than poisoning the result; definitive answers like NXDOMAIN
+        are never retried.  The final timeout is left to the caller."""
+        for _unused in range(self.retries - 1):
+            try:
+                return resolver.query(*args, **kwargs)
+            except dns.exception.Timeout:
+                continue
+        return resolver.query(*args, **kwargs)
+
+    def is_known_nxdomain(self, question, qtype="A", ctype="IN"):
+        """Whether a recent lookup of this question is known to have
+        failed (e.g. NXDOMAIN), without doing any query."""
+        if not question.endswith("."):
+            question += "."
+        try:
+            rdtype = _RDTYPES[qtype]
+            rdclass = _RDCLASSES[ctype]
+        except KeyError:
+            # This type was never looked up, so no failure is known.
+            return False
+        expiry = self.failures.get((question, rdtype, rdclass))
+        return expiry is not None and expiry > time.monotonic()
 
-    def lookup(self, question, qtype="A", ctype="IN", exact=False):
+    def lookup(self, question, qtype="A", ctype="IN", exact=False,
+               resolver=None):
         """Do an actual lookup.  'question' should be the hostname or IP to
         query, and 'qType' should be the type of record to get (e.g. TXT,
-        A, AAAA, PTR)."""
-        rdtype = dns.rdatatype.from_text(qtype)
-        rdclass = dns.rdataclass.from_text(ctype)
+        A, AAAA, PTR).
+
+        If 'resolver' is provided, it is used instead of the default
+        one, e.g. so that callers can use their own timeout."""
+        if not question.endswith("."):
+            # Make the name absolute, so that the resolver does not
+            # walk the search list on NXDOMAIN, and so that the cache
+            # sees a single canonical key per name.
+            question += "."
         try:
-            return self.failures[question, rdtype, rdclass]
+            rdtype = _RDTYPES[qtype]
         except KeyError:
-            pass
-        reply = self.queryObj.cache.get((question, rdtype, rdclass))
-        if not reply:
-            try:
-                reply = self.queryObj.query(question, rdtype, rdclass)
-            except dns.resolver.NXDOMAIN:
-                # This is actually a valid response, not an error condition.
-                self.failures[question, rdtype, rdclass] = []
-                return []
-            except dns.exception.Timeout:
-                # This may change next time this is run, so warn about that.
-                log_method = getattr(self.logger, self.timeout_log_level)
-                log_method("%s %s lookup timed out.", question, qtype)
-                self.failures[question, rdtype, rdclass] = []
-                return []
-            except (dns.resolver.NoAnswer, dns.resolver.NoNameservers) as e:
-                if qtype not in ("MX", "AAAA", "TXT"):
-                    # These indicate a problem with the nameserver.
-                    self.logger.debug("%s %s lookup failed: %s", question,
-                                      qtype, e)
-                self.failures[question, rdtype, rdclass] = []
-                return []
-            except (ValueError, IndexError) as e:
-                # A bad DNS entry.
-                self.logger.warn("%s %s lookup failed: %s", question, qtype,
-                                 e)
-                self.failures[question, rdtype, rdclass] = []
-                return []
-            except struct.error as e:
-                # A bad DNS entry.
-                self.logger.warn("%s %s lookup failed: %s", question, qtype,
-                                 e)
-                self.failures[question, rdtype, rdclass] = []
-                return []
-        self.queryObj.cache.put((question, rdtype, rdclass), reply)
+            rdtype = _RDTYPES[qtype] = dns.rdatatype.from_text(qtype)
+        try:
+            rdclass = _RDCLASSES[ctype]
+        except KeyError:
+            rdclass = _RDCLASSES[ctype] = dns.rdataclass.from_text(ctype)
+        expiry = self.failures.get((question, rdtype, rdclass))
+        if expiry is not None:
+            if expiry > time.monotonic():
+                return _EMPTY
+            # The negative result has expired; try again.
+            del self.failures[question, rdtype, rdclass]
+        if resolver is None:
+            resolver = self.queryObj
+        # The resolver consults and fills its own cache, so there is no
+        # need to check it here.
+        try:
+            reply = self._query_with_retry(resolver, question, rdtype,
+                                           rdclass)
+        except dns.resolver.NXDOMAIN as e:
+            # This is actually a valid response, not an error condition.
+            self._cache_failure((question, rdtype, rdclass),
+                                ttl=self._negative_ttl(e))
+            return _EMPTY
+        except dns.exception.Timeout:
+            # This may change next time this is run, so warn about that.
+            self._timeout_log("%s %s lookup timed out.", question, qtype)
+            self._cache_failure((question, rdtype, rdclass))
+            return _EMPTY
+        except (dns.resolver.NoAnswer, dns.resolver.NoNameservers) as e:
+            if qtype not in self._QUIET_QTYPES:
+                # These indicate a problem with the nameserver.
+                self.logger.debug("%s %s lookup failed: %s", question,
+                                  qtype, e)
+            self._cache_failure((question, rdtype, rdclass),
+                                ttl=self._negative_ttl(e))
+            return _EMPTY
+        except (ValueError, IndexError) as e:
+            # A bad DNS entry.
+            self.logger.warn("%s %s lookup failed: %s", question, qtype,
+                             e)
+            self._cache_failure((question, rdtype, rdclass))
+            return _EMPTY
+        except struct.error as e:
+            # A bad DNS entry.
+            self.logger.warn("%s %s lookup failed: %s", question, qtype,
+                             e)
+            self._cache_failure((question, rdtype, rdclass))
+            return _EMPTY
         if exact:
-            return [i.to_text() for sublist in
-                    (answer.to_rdataset().items
-                     for answer in reply.response.answer
-                     if answer.rdtype == rdtype and
-                     answer.rdclass == rdclass) for i in sublist]
-        return [i.to_text()
-                for i in reply.response.answer[0].to_rdataset().items]
+            # The answer sections are already rdatasets; there is no
+            # need to copy them with to_rdataset() just to iterate.
+            items = itertools.chain.from_iterable(
+                answer.items
+                for answer in reply.response.answer
+                if answer.rdtype == rdtype and answer.rdclass == rdclass)
+        else:
+            items = reply.rrset
+        return [i.to_text() for i in items]
 
     _CNAME = dns.rdatatype.from_text("CNAME")
     _EXPECTED_FAILURES = (
@@ -141,30 +308,31 @@ class Cache(object):
         IndexError,
         struct.error,
         )
-    def get_ns(self, domain, timeout=None):
+    def get_ns(self, domain, timeout=None, resolver=None):
         """Like query(domain, "NS"), but if the domain is a CNAME, then
         ask the domain's parent NS for the NS instead."""
-        try:
-            if self.failures[domain, "NS", "get_ns"]:
+        if resolver is None:
+            resolver = self.queryObj
+        expiry = self.failures.get((domain, "NS", "get_ns"))
+        if expiry is not None:
+            if expiry > time.monotonic():
                 return
-        except KeyError:
-            pass
+            del self.failures[domain, "NS", "get_ns"]
         reply = self.ns_cache.get(domain)
         if reply:
             for i in reply:
                 yield i
             return
         try:
-            reply = self.queryObj.query(domain, rdtype="NS",
-                                        raise_on_no_answer=False)
+            reply = self._query_with_retry(resolver, domain, rdtype="NS",
+                                           raise_on_no_answer=False)
         except dns.resolver.NXDOMAIN:
             # This is actually a valid response, not an error condition.
-            self.failures[domain, "NS", "get_ns"] = True
+            self._cache_failure((domain, "NS", "get_ns"))
             return
         except dns.exception.Timeout:
             # This may change next time this is run, so warn about that.
-            log_method = getattr(self.logger, self.timeout_log_level)
-            log_method("%s NS lookup timed out.", domain)
+            self._timeout_log("%s NS lookup timed out.", domain)
             return
         except self._EXPECTED_FAILURES as e:
             self.logger.debug("%s NS lookup failed: %s", domain, e)
@@ -186,19 +354,20 @@ class Cache(object):
                     return
                 parent_resolver = dns.resolver.Resolver(configure=False)
                 if timeout:
-                    parent_resolver.lifetime = timeout
+                    # Per-attempt budget, like the other resolvers.
+                    parent_resolver.lifetime = timeout / float(self.retries)
                 parent_resolver.nameservers = parent_ns
                 try:
-                    parent_reply = parent_resolver.query(
-                        domain, rdtype="NS", raise_on_no_answer=False)
+                    parent_reply = self._query_with_retry(
+                        parent_resolver, domain, rdtype="NS",
+                        raise_on_no_answer=False)
                 except dns.resolver.NXDOMAIN:
                     # This is actually a valid response, not an error condition.
-                    self.failures[domain, "NS", "get_ns"] = True
+                    self._cache_failure((domain, "NS", "get_ns"))
                     return
                 except dns.exception.Timeout:
                     # This may change next time this is run, so warn about that.
-                    log_method = getattr(self.logger, self.timeout_log_level)
-                    log_method("%s NS parent lookup timed out.", domain)
+                    self._timeout_log("%s NS parent lookup timed out.", domain)
                     return
                 except self._EXPECTED_FAILURES as e:
                     self.logger.debug("%s NS parent lookup failed: %s", domain, e)
@@ -208,7 +377,7 @@ class Cache(object):
                     yield part_answer
                     full_answer.append(part_answer)
             else:
-                for i in answer.to_rdataset().items:
+                for i in answer.items:
                     part_answer = i.to_text()
                     yield part_answer
                     full_answer.append(part_answer)
@@ -224,37 +393,124 @@ class _DNSCache(Cache):
     query the combined list.
     """
 
-    def __init__(self, config_path=CONFIG_PATH):
+    def __init__(self, config_path=CONFIG_PATH, config=None):
         super(_DNSCache, self).__init__()
         # These are the lists that we combine (we don't combine everything,
         # because we can't combine white and black lists, and we don't
         # combine lists that return multiple results).
         # Note that DNSBL and URLBL are convenient labels, but DNSWL and
         # URLYL may also be also here.
-        if os.path.exists(config_path):
-            with open(config_path, "r") as fh:
-                data = json.load(fh)
+        # A pre-parsed configuration may be passed in; otherwise the
+        # file is loaded (cached across constructions).
+        if config is None:
+            data = _load_config(config_path)
         else:
-            data = {
-              "COMBINED": "",
-              "COMBINED_URL": "",
-              "COMBINED_DNSBL": {},
-              "COMBINED_DNSBL_REVERSE": {},
-              "COMBINED_URLBL": {},
-              "COMBINED_URLBL_REVERSE": {}
-            }
+            data = config
         self.COMBINED = data["COMBINED"]
         self.COMBINED_URL = data["COMBINED_URL"]
         self.COMBINED_DNSBL = data["COMBINED_DNSBL"]
         self.COMBINED_DNSBL_REVERSE = data["COMBINED_DNSBL_REVERSE"]
-        self.COMBINED_DNSBL_REVERSE_VALUES = \
-            self.COMBINED_DNSBL_REVERSE.values()
         self.COMBINED_URLBL = data["COMBINED_URLBL"]
         self.COMBINED_URLBL_REVERSE = data["COMBINED_URLBL_REVERSE"]
+        # Rewrite decisions per question, so that bulk scanners only pay
+        # for the split/join work once per distinct FQDN.
+        self._rewrite_cache = {}
+        self._build_suffix_map()
+
+    def _build_suffix_map(self):
+        """(Re)build the list-suffix dispatch table.
+
+        This maps each list name that a combined list handles to the
+        (combined domain, reverse map, log message) used for the
+        rewrite, so that _classify does a single dict probe rather than
+        scanning both reverse maps.  Call this again if the combined
+        configuration is changed after construction."""
+        # Derived views of the reverse maps; frozensets rather than
+        # dict.values(), so that membership checks are O(1) rather
+        # than a linear scan.
+        self.COMBINED_DNSBL_REVERSE_VALUES = \
+            frozenset(self.COMBINED_DNSBL_REVERSE.values())
         self.COMBINED_URLBL_REVERSE_VALUES = \
-            self.COMBINED_URLBL_REVERSE.values()
+            frozenset(self.COMBINED_URLBL_REVERSE.values())
+        suffix_map = {}
+        if self.COMBINED:
+            for list_name in self.COMBINED_DNSBL_REVERSE_VALUES:
+                suffix_map[list_name] = (
+                    self.COMBINED, self.COMBINED_DNSBL_REVERSE,
+                    "Rewriting %s to use combined list.")
+        if self.COMBINED_URL:
+            for list_name in self.COMBINED_URLBL_REVERSE_VALUES:
+                suffix_map.setdefault(list_name, (
+                    self.COMBINED_URL, self.COMBINED_URLBL_REVERSE,
+                    "Rewriting %s to use url combined list."))
+        self._suffix_map = suffix_map
+        self._rewrite_cache.clear()
+
+    _REWRITE_CACHE_MAX_SIZE = 8192
+
+    def _classify(self, question):
+        """Decide whether the question is for a list that a combined
+        list handles.
+
+        Returns a (rewrite_answer, question, listed_answers) tuple,
+        where 'question' is rewritten to query the combined list when
+        appropriate and 'listed_answers' is the set of combined answers
+        that mean "listed" for the original list.  The decision is
+        cached per question."""
+        key = question
+        try:
+            return self._rewrite_cache[key]
+        except KeyError:
+            pass
+        rewrite_answer = None
+        reverse_dict = None
 
-    def lookup(self, question, qtype="A", ctype="IN", exact=False):
+        # XXX It would be better if this worked with any naming scheme.
+        # Our lists always have 4 labels.
+        # E.g: list1.dnsbl.example.com
+
+        # Find where the last 4 labels start, without building a list
+        # of every label.
+        i = len(question)
+        for _unused in range(4):
+            i = question.rfind(".", 0, i)
+            if i < 0:
+                break
+        original_list = question[i + 1:]
+
+        entry = self._suffix_map.get(original_list)
+        if entry is not None:
+            combined, reverse_dict, log_message = entry
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(log_message, question)
+            rewrite_answer = original_list
+            # Intern the absolute form, so that the dot-appending in
+            # Cache.lookup short-circuits and the object probing the
+            # failure and resolver caches is this one interned string
+            # (with its cached hash), even across _DNSCache instances.
+            question = question[:max(i, 0)] + "." + combined
+            if not question.endswith("."):
+                question += "."
+            question = sys.intern(question)
+
+        listed_answers = None
+        if reverse_dict is not None:
+            # Invert the reverse map for this list once, so that the
+            # "is it listed?" check is a set operation per lookup.
+            listed_answers = frozenset(
+                answer for answer, list_name in reverse_dict.items()
+                if list_name == rewrite_answer)
+
+        if len(self._rewrite_cache) >= self._REWRITE_CACHE_MAX_SIZE:
+            # Keep the cache bounded; simply starting over is cheaper
+            # than tracking which entries are stale.
+            self._rewrite_cache.clear()
+        result = (rewrite_answer, question, listed_answers)
+        self._rewrite_cache[key] = result
+        return result
+
+    def lookup(self, question, qtype="A", ctype="IN", exact=False,
+               resolver=None):
         """Do an actual lookup.  'question' should be the hostname or IP
         to query, and 'qType' should be the type of record to get
         (e.g. TXT, A, AAAA, PTR).
@@ -273,49 +529,37 @@ class _DNSCache(Cache):
         not listed, the result is an empty list.
         When the question is one for one of the lists handled by
         a combined list, and the result indicates that the address is
-        listed, the result is always ["127.0.0.2"] - it is *not* the
+        listed, the result is always ("127.0.0.2",) - it is *not* the
         raw combined result.
         """
-        logger = logging.getLogger("se-dns")
-        rewrite_answer = None
-        reverse_dict = None
-
-        # XXX It would be better if this worked with any naming scheme.
-        # Our lists always have 4 labels.
-        # E.g: list1.dnsbl.example.com
-
-        question_split = question.split(".")
-        original_list = ".".join(question_split[-4:])
-        address = ".".join(question_split[:-4])
-
-        if (original_list in self.COMBINED_DNSBL_REVERSE_VALUES and
-                self.COMBINED):
-            logger.debug("Rewriting %s to use combined list.", question)
-            rewrite_answer = original_list
-            question = address + "." + self.COMBINED
-            reverse_dict = self.COMBINED_DNSBL_REVERSE
-        elif (original_list in self.COMBINED_URLBL_REVERSE_VALUES
-              and self.COMBINED_URL):
-            logger.debug("Rewriting %s to use url combined list.", question)
-            rewrite_answer = original_list
-            question = address + "." + self.COMBINED_URL
-            reverse_dict = self.COMBINED_URLBL_REVERSE
-
-        logger.debug("Looking up %s: %s", qtype, question)
-        result = super(_DNSCache, self).lookup(question, qtype, ctype, exact)
+        if not self._suffix_map:
+            # No combined list is configured, so there is nothing to
+            # rewrite; skip the question juggling below.
+            return super(_DNSCache, self).lookup(question, qtype, ctype,
+                                                 exact, resolver)
+        original_question = question
+        rewrite_answer, question, listed_answers = self._classify(question)
+
+        # Skip building the debug arguments when nobody is listening.
+        logger = self.logger
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Looking up %s: %s", qtype, question)
+        result = super(_DNSCache, self).lookup(question, qtype, ctype, exact,
+                                               resolver)
 
         if rewrite_answer and result:
-            for answer in result:
-                if reverse_dict.get(answer) == rewrite_answer:
-                    logger.debug("Converting %s from %s to ['127.0.0.2'] "
-                                 "from %s.%s.", result, question, address,
-                                 rewrite_answer)
-                    result = ["127.0.0.2"]
-                    break
-            else:
-                logger.debug("Ignoring %s from %s w.r.t. %s.%s", result,
-                             question, address, rewrite_answer)
+            if listed_answers.isdisjoint(result):
+                if debug:
+                    logger.debug("Ignoring %s from %s w.r.t. %s", result,
+                                 question, original_question)
                 result = []
+            else:
+                if debug:
+                    logger.debug("Converting %s from %s to %s for %s.",
+                                 result, question, _LISTED,
+                                 original_question)
+                result = _LISTED
         return result
 
 
@@ -328,6 +572,14 @@ class DNSCache(object):
 
     def __init__(self, dnstimeout=10):
         self.dnsTimeout = dnstimeout
+        # A resolver of our own, so that the module's timeout does not
+        # have to be poked into the shared resolver for every call
+        # (which was not thread-safe).  The cache is still shared.
+        self._resolver = copy.copy(_default_resolver())
+        # The central cache retries timeouts, so split this module's
+        # budget across the attempts, like Cache.__init__ does.
+        self._resolver.lifetime = dnstimeout / float(_DNS_CACHE.retries)
+        self._resolver.cache = _DNS_CACHE.queryObj.cache
         self.COMBINED_DNSBL = _DNS_CACHE.COMBINED_DNSBL
         self.COMBINED_DNSBL_REVERSE = _DNS_CACHE.COMBINED_DNSBL_REVERSE
         self.COMBINED_DNSBL_REVERSE_VALUES = \
@@ -339,12 +591,17 @@ class DNSCache(object):
 
     def lookup(self, question, qtype="A", ctype="IN", exact=False):
         """Like Cache.lookup()"""
-        # XXX This is not thread-safe
-        _DNS_CACHE.queryObj.lifetime = self.dnsTimeout
-        return _DNS_CACHE.lookup(question, qtype, ctype, exact)
+        return _DNS_CACHE.lookup(question, qtype, ctype, exact,
+                                 resolver=self._resolver)
 
     def get_ns(self, domain):
         """Like Cache.get_ns()"""
-        # XXX This is not thread-safe
-        _DNS_CACHE.queryObj.lifetime = self.dnsTimeout
-        return _DNS_CACHE.get_ns(domain, self.dnsTimeout)
+        return _DNS_CACHE.get_ns(domain, self.dnsTimeout,
+                                 resolver=self._resolver)
+
+    def is_known_nxdomain(self, question, qtype="A", ctype="IN"):
+        """Like Cache.is_known_nxdomain()"""
+        return _DNS_CACHE.is_known_nxdomain(question, qtype, ctype)
+
+    # So that callers with only the proxy can build PTR questions.
+    reverse_name = staticmethod(reverse_name)
@@ -5,7 +5,7 @@ from __future__ import absolute_import
 import se_dns
 import distutils.core
 
-REQUIRES = ["dnspython"]
+REQUIRES = ["dnspython", "psutil"]
 DESCRIPTION = """Simple dns tools."""
 
 CLASSIFIERS = [
@@ -0,0 +1,161 @@
+import socket
+import unittest
+from collections import namedtuple
+
+from mock import patch
+
+from se_dns import dnstools
+
+
+# Mirrors the fields of psutil's snicaddr that we care about.
+Address = namedtuple("Address", ["family", "address"])
+
+
+def _start_patch(test, *args, **kwargs):
+    """Start a patcher that stops with the test.
+
+    addCleanup pops in LIFO order per test, unlike patch.stopall(),
+    which walks mock's global active-patch list."""
+    patcher = patch(*args, **kwargs)
+    test.addCleanup(patcher.stop)
+    return patcher.start()
+
+
+class TestLocalIPAddresses(unittest.TestCase):
+    """Tests for the dnstools.local_ip_addresses function."""
+
+    def setUp(self):
+        dnstools._LOCAL_IP_ADDRESSES_CACHE.clear()
+        self.mock_net_if_addrs = _start_patch(
+            self, "se_dns.dnstools.psutil.net_if_addrs")
+        _start_patch(self, "se_dns.dnstools.os.path.exists",
+                     return_value=True)
+        _start_patch(self, "se_dns.dnstools.open")
+        _start_patch(self, "se_dns.dnstools.json.dump")
+
+    def test_filters_local_addresses(self):
+        """Test that loopback and link-local addresses are excluded."""
+        self.mock_net_if_addrs.return_value = {
+            "lo": [Address(socket.AF_INET, "127.0.0.1"),
+                   Address(socket.AF_INET6, "::1")],
+            "eth0": [Address(socket.AF_INET, "192.0.2.1"),
+                     Address(socket.AF_INET6, "fe80::1%eth0"),
+                     Address(socket.AF_INET6, "2001:db8::1"),
+                     Address(socket.AF_PACKET, "00:00:5e:00:53:00")],
+        }
+        result = dnstools.local_ip_addresses("test-cache")
+        self.assertEqual(sorted(result), ["192.0.2.1", "2001:db8::1"])
+
+    def test_memoized_per_process(self):
+        """Test that a second call does not query the interfaces again."""
+        self.mock_net_if_addrs.return_value = {
+            "eth0": [Address(socket.AF_INET, "192.0.2.1")],
+        }
+        first = dnstools.local_ip_addresses("test-cache", use_cached=True)
+        second = dnstools.local_ip_addresses("test-cache", use_cached=True)
+        self.assertEqual(first, second)
+        self.mock_net_if_addrs.assert_called_once()
+
+    def test_fresh_data_requested(self):
+        """Test that use_cached=False bypasses the in-process memo."""
+        self.mock_net_if_addrs.return_value = {
+            "eth0": [Address(socket.AF_INET, "192.0.2.1")],
+        }
+        dnstools.local_ip_addresses("test-cache")
+        dnstools.local_ip_addresses("test-cache")
+        self.assertEqual(self.mock_net_if_addrs.call_count, 2)
+
+    def test_use_cached(self):
+        """Test that a fresh cache file is used instead of the interfaces."""
+        mock_stat = _start_patch(self, "se_dns.dnstools.os.stat")
+        mock_stat.return_value.st_mtime = dnstools.time.time()
+        _start_patch(self, "se_dns.dnstools.json.load",
+                     return_value=["192.0.2.7"])
+
+        result = dnstools.local_ip_addresses("test-cache", use_cached=True)
+
+        self.assertEqual(result, ["192.0.2.7"])
+        self.mock_net_if_addrs.assert_not_called()
+
+
+class TestNameToIP(unittest.TestCase):
+    """Tests for the dnstools.name_to_ip function."""
+
+    def setUp(self):
+        dnstools._NAME_TO_IP_CACHE.clear()
+        self.mock_getaddrinfo = _start_patch(
+            self, "se_dns.dnstools.socket.getaddrinfo")
+        self.mock_getaddrinfo.return_value = [
+            (socket.AF_INET, None, None, None, ("192.0.2.1", 0)),
+            (socket.AF_INET6, None, None, None, ("2001:db8::1", 0, 0, 0)),
+        ]
+
+    def test_prefer_ipv6(self):
+        """Test that the IPv6 address is preferred by default."""
+        self.assertEqual(dnstools.name_to_ip("example.com"), "2001:db8::1")
+
+    def test_prefer_ipv4(self):
+        """Test that the IPv4 address is returned when IPv6 is not
+        preferred."""
+        self.assertEqual(dnstools.name_to_ip("example.com",
+                                             prefer_ipv6=False),
+                         "192.0.2.1")
+
+    def test_memoized(self):
+        """Test that a repeated resolution is served from the cache."""
+        first = dnstools.name_to_ip("example.com")
+        second = dnstools.name_to_ip("example.com")
+        self.assertEqual(first, second)
+        self.mock_getaddrinfo.assert_called_once()
+
+
+class TestHostsEqual(unittest.TestCase):
+    """Tests for the dnstools.hosts_equal function."""
+
+    def setUp(self):
+        patcher = patch.object(dnstools.DNS_CACHE, "lookup")
+        self.addCleanup(patcher.stop)
+        self.mock_lookup = patcher.start()
+
+    def test_same_name(self):
+        """Test that identical names match without any lookup."""
+        self.assertTrue(dnstools.hosts_equal("a.example.com",
+                                             "a.example.com", "test-cache"))
+        self.mock_lookup.assert_not_called()
+
+    def test_matching_a_records(self):
+        """Test that hosts that share an A record are equal."""
+        def lookup(host, qtype="A", exact=False):
+            if qtype == "A":
+                return ["192.0.2.1"]
+            return ["2001:db8::1"]
+        self.mock_lookup.side_effect = lookup
+
+        self.assertTrue(dnstools.hosts_equal("a.example.com",
+                                             "b.example.com", "test-cache"))
+
+    def test_no_match(self):
+        """Test that hosts with disjoint addresses are not equal."""
+        def lookup(host, qtype="A", exact=False):
+            if host == "a.example.com":
+                return ["192.0.2.1"]
+            return ["192.0.2.2"]
+        self.mock_lookup.side_effect = lookup
+
+        self.assertFalse(dnstools.hosts_equal("a.example.com",
+                                              "b.example.com", "test-cache",
+                                              skip_getaddrinfo=True))
+
+
+def suite():
+    """Create a suite that includes all tests."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestLocalIPAddresses, 'test'))
+    test_suite.addTest(unittest.makeSuite(TestNameToIP, 'test'))
+    test_suite.addTest(unittest.makeSuite(TestHostsEqual, 'test'))
+
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,124 +1,234 @@
 import unittest
+from types import SimpleNamespace
+from collections import namedtuple
+
 from mock import MagicMock, patch
 
 from se_dns import dnsutil
 
 
+# One answer item; .to_text holds the callable returning its text.
+Item = namedtuple("Item", ["to_text"])
+
+# The error responses that should end up in the failure cache.
+SIDE_EFFECTS = (
+    dnsutil.dns.resolver.NXDOMAIN,
+    dnsutil.dns.exception.Timeout,
+    dnsutil.dns.resolver.NoAnswer,
+    IndexError,
+    dnsutil.struct.error,
+)
+
+
 class TestCache(unittest.TestCase):
     """Tests for the dnsutil.Cache class."""
 
+    @classmethod
+    def setUpClass(cls):
+        # Start the patchers once per class; activating a patcher is
+        # surprisingly costly, and these are identical for every test.
+        cls.mock_logger = MagicMock()
+        cls.mock_resolver = MagicMock()
+        cls.mock_cache = MagicMock()
+        cls._patchers = [
+            patch("se_dns.dnsutil._LOGGER", cls.mock_logger),
+            patch("se_dns.dnsutil.dns.resolver.Resolver",
+                  return_value=cls.mock_resolver),
+            patch("se_dns.dnsutil.dns.resolver.LRUCache",
+                  return_value=cls.mock_cache),
+            patch("se_dns.dnsutil.dns.rdatatype.from_text"),
+            patch("se_dns.dnsutil.dns.rdataclass.from_text"),
+        ]
+        mocks = [patcher.start() for patcher in cls._patchers]
+        cls.mock_rdtype = mocks[3]
+        cls.mock_rdclass = mocks[4]
+        # One shared instance; the tests only vary mock state, so
+        # there is no need to reconstruct it for every test.
+        dnsutil._default_resolver.cache_clear()
+        cls.tested_obj = dnsutil.Cache("dnsserver")
+
+    @classmethod
+    def tearDownClass(cls):
+        for patcher in cls._patchers:
+            patcher.stop()
+
     def setUp(self):
-        self.mock_logger = MagicMock()
-        self.mock_resolver = MagicMock()
-        self.mock_cache = MagicMock()
-        patch("se_dns.dnsutil.logging.getLogger",
-              return_value=self.mock_logger).start()
-        patch("se_dns.dnsutil.dns.resolver.Resolver",
-              return_value=self.mock_resolver).start()
-        patch("se_dns.dnsutil.dns.resolver.Cache",
-              return_value=self.mock_cache).start()
-        self.mock_rdtype = patch("se_dns.dnsutil.dns.rdatatype.from_text").start()
-        self.mock_rdclass = patch("se_dns.dnsutil.dns.rdataclass.from_text").start()
-
-    def tearDown(self):
-        patch.stopall()
+        self.mock_logger.reset_mock()
+        self.mock_resolver.reset_mock()
+        self.mock_cache.reset_mock()
+        self.tested_obj.failures.clear()
+        self.tested_obj.ns_cache.clear()
+        self.tested_obj.queryObj.query = MagicMock()
+        dnsutil._RDTYPES.clear()
+        dnsutil._RDCLASSES.clear()
 
     def test_init(self):
         """Test that we initialize the fields correctly."""
-        tested_obj = dnsutil.Cache("dnsserver")
+        tested_obj = self.tested_obj
 
         self.assertEqual(tested_obj.queryObj.nameservers, ["dnsserver"])
-        self.assertEqual(tested_obj.queryObj.lifetime, 10)
+        # The overall 10 second budget is split over the attempts.
+        self.assertEqual(tested_obj.retries, 3)
+        self.assertEqual(tested_obj.queryObj.lifetime, 10 / 3.0)
         self.mock_logger.warn.assert_not_called()
 
-    def test_lookup_use_cache(self):
-        """Test that the lookup uses the cache values."""
-        reply = MagicMock()
-        items = [MagicMock(to_text=lambda: 1)]
-        reply.response.answer = [
-            MagicMock(to_rdataset=lambda: MagicMock(items=items))
-        ]
-        self.mock_cache.get.return_value = reply
+    def test_lookup(self):
+        """Test that we query correctly and parse the answer."""
+        # The reply is only read, so a plain namespace is enough (and
+        # much cheaper than a MagicMock tree).
+        reply = SimpleNamespace(rrset=[Item(to_text=lambda: 1)])
+        tested_obj = self.tested_obj
+        tested_obj.queryObj.query.return_value = reply
 
-        tested_obj = dnsutil.Cache("dnsserver")
         result = tested_obj.lookup("test.question")
 
         self.assertEqual(result, [1])
-        tested_obj.queryObj.query.assert_not_called()
-
-    def test_lookup_no_cache(self):
-        """Test that we query correctly and update the cache when no cache
-        is available."""
-        self.mock_cache.get.return_value = None
-        cache_line = (
-            "test.question",
+        tested_obj.queryObj.query.assert_called_with(
+            "test.question.",
             self.mock_rdtype.return_value,
-            self.mock_rdclass.return_value
-        )
-        tested_obj = dnsutil.Cache("dnsserver")
-        tested_obj.lookup("test.question")
-
-        query_func = tested_obj.queryObj.query
-        query_func.assert_called_with(*cache_line)
-        tested_obj.queryObj.cache.put.assert_called_with(cache_line,
-                                                         query_func.return_value)
+            self.mock_rdclass.return_value)
 
     def test_lookup_cache_failure(self):
         """Test that we use the failure cache with various errors."""
         question = "test.question"
-        side_effects = [
-            dnsutil.dns.resolver.NXDOMAIN,
-            dnsutil.dns.exception.Timeout,
-            dnsutil.dns.resolver.NoAnswer,
-            IndexError,
-            dnsutil.struct.error
+        tested_obj = self.tested_obj
+        query = tested_obj.queryObj.query
+        expected_queries = 0
+        for side_effect in SIDE_EFFECTS:
+            with self.subTest(error=side_effect):
+                tested_obj.failures.clear()
+                if side_effect is dnsutil.dns.exception.Timeout:
+                    # Timeouts are retried before the failure is cached.
+                    effects = [side_effect] * tested_obj.retries
+                else:
+                    effects = [side_effect]
+                expected_queries += len(effects)
+                query.side_effect = effects + [MagicMock()]
+
+                # first time should fail
+                result = tested_obj.lookup(question)
+                self.assertEqual(result, dnsutil._EMPTY)
+
+                # second time we should use the failures cache; if it
+                # queried anyway, it would get the sentinel reply and
+                # the result would not be empty.
+                result = tested_obj.lookup(question)
+                self.assertEqual(result, dnsutil._EMPTY)
+        # One batched check instead of counting per iteration.
+        self.assertEqual(query.call_count, expected_queries)
+
+
+class TestIsKnownNXDOMAIN(unittest.TestCase):
+    """Tests for the Cache.is_known_nxdomain method."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._patchers = [
+            patch("se_dns.dnsutil._LOGGER"),
+            patch("se_dns.dnsutil.dns.resolver.Resolver"),
+            patch("se_dns.dnsutil.dns.resolver.LRUCache"),
+            patch("se_dns.dnsutil.dns.rdatatype.from_text"),
+            patch("se_dns.dnsutil.dns.rdataclass.from_text"),
         ]
+        for patcher in cls._patchers:
+            patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patcher in cls._patchers:
+            patcher.stop()
+
+    def setUp(self):
+        dnsutil._RDTYPES.clear()
+        dnsutil._RDCLASSES.clear()
+        dnsutil._default_resolver.cache_clear()
+
+    def test_known_failure(self):
+        """Test that a failed lookup is reported, without querying."""
+        tested_obj = dnsutil.Cache("dnsserver")
+        tested_obj.queryObj.query = MagicMock(
+            side_effect=dnsutil.dns.resolver.NXDOMAIN)
 
-        for side_effect in side_effects:
-            tested_obj = dnsutil.Cache('dnsserver')
-            tested_obj.queryObj.cache.get = MagicMock(return_value=None)
-            tested_obj.queryObj.query.side_effect = [side_effect, MagicMock()]
+        self.assertFalse(tested_obj.is_known_nxdomain("test.question"))
+        tested_obj.lookup("test.question")
+        self.assertTrue(tested_obj.is_known_nxdomain("test.question"))
+        tested_obj.queryObj.query.assert_called_once()
+
+
+class TestReverseName(unittest.TestCase):
+    """Tests for the dnsutil.reverse_name helper."""
 
-            # first time should fail
-            result = tested_obj.lookup(question)
-            self.assertEqual(result, [])
+    def test_ipv4(self):
+        """Test that IPv4 addresses are reversed with string work."""
+        self.assertEqual(dnsutil.reverse_name("192.0.2.1"),
+                         "1.2.0.192.in-addr.arpa.")
 
-            # second time we should use the failures cache
-            result = tested_obj.lookup(question)
-            self.assertEqual(result, [])
-            tested_obj.queryObj.cache.get.assert_called_once()
+    def test_ipv6(self):
+        """Test that IPv6 addresses fall back to dns.reversename."""
+        self.assertEqual(dnsutil.reverse_name("2001:db8::1"),
+                         "1.0.0.0." + "0.0.0.0." * 5 +
+                         "8.b.d.0.1.0.0.2.ip6.arpa.")
 
 
 class Test_DNSCache(unittest.TestCase):
     """Tests for the dnsutil._DNSCache class."""
 
+    @classmethod
+    def setUpClass(cls):
+        cls.mock_resolver = MagicMock()
+        cls.mock_cache = MagicMock()
+        cls._patchers = [
+            patch("se_dns.dnsutil._LOGGER"),
+            patch("se_dns.dnsutil.dns.resolver.Resolver",
+                  return_value=cls.mock_resolver),
+            patch("se_dns.dnsutil.dns.resolver.LRUCache",
+                  return_value=cls.mock_cache),
+            patch("se_dns.dnsutil.os.path.exists", return_value=False),
+            patch("se_dns.dnsutil.Cache.lookup",
+                  return_value=["cache.result"]),
+        ]
+        mocks = [patcher.start() for patcher in cls._patchers]
+        cls.mock_lookup = mocks[4]
+        # One shared instance; tests reconfigure its combined lists
+        # and the snapshot below restores them afterwards.
+        dnsutil._load_config.cache_clear()
+        dnsutil._default_resolver.cache_clear()
+        cls.tested_obj = dnsutil._DNSCache()
+        cls._initial_state = dict(cls.tested_obj.__dict__)
+
+    @classmethod
+    def tearDownClass(cls):
+        for patcher in cls._patchers:
+            patcher.stop()
+
     def setUp(self):
-        self.mock_resolver = MagicMock()
-        self.mock_cache = MagicMock()
-        patch("se_dns.dnsutil.logging.getLogger").start()
-        patch("se_dns.dnsutil.dns.resolver.Resolver",
-              return_value=self.mock_resolver).start()
-        patch("se_dns.dnsutil.dns.resolver.Cache",
-              return_value=self.mock_cache).start()
-        patch("se_dns.dnsutil.os.path.exists", return_value=False).start()
-        self.mock_lookup = patch("se_dns.dnsutil.Cache.lookup",
-                                 return_value=["cache.result"]).start()
-
-    def tearDown(self):
-        patch.stopall()
+        self.mock_resolver.reset_mock()
+        self.mock_cache.reset_mock()
+        self.mock_lookup.reset_mock()
+        # The snapshot rebinds the attributes tests assign; the caches
+        # are shared objects, so empty them as well.
+        self.addCleanup(self.tested_obj.__dict__.update,
+                        self._initial_state.copy())
+        self.addCleanup(self.tested_obj._rewrite_cache.clear)
+        self.addCleanup(self.tested_obj.failures.clear)
 
     def test_init(self):
         """Test that we initialize fields correctly."""
-        tested_obj = dnsutil._DNSCache()
+        tested_obj = self.tested_obj
         self.assertEqual(tested_obj.COMBINED, "")
         self.assertEqual(tested_obj.COMBINED_DNSBL, {})
-        self.assertEqual(tested_obj.queryObj.lifetime, 10)
+        # Locked in: membership checks must stay O(1).
+        self.assertIsInstance(tested_obj.COMBINED_DNSBL_REVERSE_VALUES,
+                              frozenset)
+        self.assertIsInstance(tested_obj.COMBINED_URLBL_REVERSE_VALUES,
+                              frozenset)
+        self.assertEqual(tested_obj.queryObj.lifetime, 10 / 3.0)
 
     def test_lookup(self):
         """Test that we return the super lookup method result if
         the question is not listed in the combined URLBL or DNSBL lists."""
         question = "list1.dnsbl.example.com"
-        tested_obj = dnsutil._DNSCache()
+        tested_obj = self.tested_obj
         result = tested_obj.lookup(question)
         self.assertEqual(result, ["cache.result"])
 
@@ -126,63 +236,63 @@ class Test_DNSCache(unittest.TestCase):
         """Test that we rewrite the query if it's handled by the combined DNSBL
         list, but the question is not listed."""
         question = "test.list1.dnsbl.example.com"
-        tested_obj = dnsutil._DNSCache()
+        tested_obj = self.tested_obj
         tested_obj.COMBINED = "combined.list"
         tested_obj.COMBINED_DNSBL_REVERSE = {"cache1.result": "list1.dnsbl.example.com"}
-        tested_obj.COMBINED_DNSBL_REVERSE_VALUES = tested_obj.COMBINED_DNSBL_REVERSE.values()
+        tested_obj._build_suffix_map()
 
         result = tested_obj.lookup(question)
         self.assertEqual(result, [])
-        self.mock_lookup.assert_called_with('test.combined.list', 'A', 'IN', False)
+        self.mock_lookup.assert_called_with('test.combined.list.', 'A', 'IN', False, None)
 
     def test_lookup_combined_match(self):
         """Test that we rewrite the query if it's handled by the combined DNSBL
         list and the question is listed."""
         question = "test.list1.dnsbl.example.com"
-        tested_obj = dnsutil._DNSCache()
+        tested_obj = self.tested_obj
         tested_obj.COMBINED = "combined.list"
         tested_obj.COMBINED_DNSBL_REVERSE = {"cache.result": "list1.dnsbl.example.com"}
-        tested_obj.COMBINED_DNSBL_REVERSE_VALUES = tested_obj.COMBINED_DNSBL_REVERSE.values()
+        tested_obj._build_suffix_map()
 
         result = tested_obj.lookup(question)
-        self.assertEqual(result, ["127.0.0.2"])
-        self.mock_lookup.assert_called_with('test.combined.list', 'A', 'IN', False)
+        self.assertEqual(result, dnsutil._LISTED)
+        self.mock_lookup.assert_called_with('test.combined.list.', 'A', 'IN', False, None)
 
     def test_lookup_combined_url_no_match(self):
         """Test that we rewrite the query if it's handled by the combined URLBL
         list, but the question is not listed."""
         question = "test.list1.urlbl.example.com"
-        tested_obj = dnsutil._DNSCache()
+        tested_obj = self.tested_obj
         tested_obj.COMBINED_URL = "combined.url"
         tested_obj.COMBINED_URLBL_REVERSE = {"cache1.result": "list1.urlbl.example.com"}
-        tested_obj.COMBINED_URLBL_REVERSE_VALUES = tested_obj.COMBINED_URLBL_REVERSE.values()
+        tested_obj._build_suffix_map()
 
         result = tested_obj.lookup(question)
         self.assertEqual(result, [])
-        self.mock_lookup.assert_called_with('test.combined.url', 'A', 'IN', False)
+        self.mock_lookup.assert_called_with('test.combined.url.', 'A', 'IN', False, None)
 
     def test_lookup_combined_url_match(self):
         """Test that we rewrite the query if it's handled by the combined URLBL
         list and the question is listed."""
         question = "test.list1.urlbl.example.com"
-        tested_obj = dnsutil._DNSCache()
+        tested_obj = self.tested_obj
         tested_obj.COMBINED_URL = "combined.url"
         tested_obj.COMBINED_URLBL_REVERSE = {"cache.result": "list1.urlbl.example.com"}
-        tested_obj.COMBINED_URLBL_REVERSE_VALUES = tested_obj.COMBINED_URLBL_REVERSE.values()
+        tested_obj._build_suffix_map()
 
         result = tested_obj.lookup(question)
-        self.assertEqual(result, ["127.0.0.2"])
-        self.mock_lookup.assert_called_with('test.combined.url', 'A', 'IN', False)
+        self.assertEqual(result, dnsutil._LISTED)
+        self.mock_lookup.assert_called_with('test.combined.url.', 'A', 'IN', False, None)
 
 
 class TestDNSCache(unittest.TestCase):
     """Tests for the dnsutil.DNSCache class."""
 
     def setUp(self):
-        self.mock_global_cache = patch("se_dns.dnsutil._DNS_CACHE").start()
-
-    def tearDown(self):
-        patch.stopall()
+        patcher = patch("se_dns.dnsutil._DNS_CACHE")
+        self.addCleanup(patcher.stop)
+        self.mock_global_cache = patcher.start()
+        self.mock_global_cache.retries = 3
 
     def test_lookup_uses_global_cache(self):
         """Test that we use the global cache when doing a lookup."""
@@ -190,14 +300,19 @@ class TestDNSCache(unittest.TestCase):
         tested_obj = dnsutil.DNSCache(20)
         tested_obj.lookup(question)
 
-        self.mock_global_cache.lookup.assert_called_with(question, "A", "IN", False)
-        self.assertEqual(self.mock_global_cache.queryObj.lifetime, 20)
+        self.mock_global_cache.lookup.assert_called_with(
+            question, "A", "IN", False, resolver=tested_obj._resolver)
+        # The 20 second budget is split over the central cache's
+        # attempts.
+        self.assertEqual(tested_obj._resolver.lifetime, 20 / 3.0)
 
 
 def suite():
     """Create a suite that includes all tests."""
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(TestCache, 'test'))
+    test_suite.addTest(unittest.makeSuite(TestIsKnownNXDOMAIN, 'test'))
+    test_suite.addTest(unittest.makeSuite(TestReverseName, 'test'))
     test_suite.addTest(unittest.makeSuite(Test_DNSCache, 'test'))
     test_suite.addTest(unittest.makeSuite(TestDNSCache, 'test'))
 